@@ -10,25 +10,166 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-from django.contrib import admin
+from datetime import timedelta
 
-from djxero.models import XeroAuthFlowState, XeroUser, XeroSecret
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db.models import Count, Q
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+
+from djxero.models import XeroAuthFlowState, XeroUser, XeroSecret, \
+    XeroOutboxItem
+
+# sessions expiring within this window are reported as "expiring"
+EXPIRING_WINDOW = timedelta(minutes=5)
+# auth flows older than this were abandoned
+STALE_FLOW_AGE = timedelta(hours=1)
+
+
+def _session_filters(now=None):
+    """
+    :return: dict of Q objects for active, expiring and expired sessions
+    """
+    now = now or timezone.now()
+    soon = now + EXPIRING_WINDOW
+    return {
+        'active': Q(oauth_expires_at__gt=soon),
+        'expiring': Q(oauth_expires_at__gt=now, oauth_expires_at__lte=soon),
+        'expired': Q(oauth_expires_at__lte=now) |
+                   Q(oauth_expires_at__isnull=True),
+    }
+
+
+class SessionListFilter(admin.SimpleListFilter):
+    """ Filter users by session state, on indexed oauth_expires_at """
+    title = 'session'
+    parameter_name = 'session'
+
+    def lookups(self, request, model_admin):
+        return (('active', 'Active'),
+                ('expiring', 'Expiring'),
+                ('expired', 'Expired'))
+
+    def queryset(self, request, queryset):
+        filters = _session_filters()
+        if self.value() in filters:
+            return queryset.filter(filters[self.value()])
+        return queryset
 
 
 @admin.register(XeroAuthFlowState)
 class XeroAuthFlowAdmin(admin.ModelAdmin):
-    date_hierarchy = "created_on"
     list_display = ('oauth_token', 'created_on', 'next_page')
+    list_filter = ('created_on',)
+    ordering = ('-created_on',)
+    show_full_result_count = False
 
 
 @admin.register(XeroUser)
 class XeroUserAdmin(admin.ModelAdmin):
-    list_display = ('user', 'updated_on')
-    search_fields = ['user__username',
-                     'user__last_name', 'user__first_name',
-                     'org']
+    list_display = ('user', 'org', 'oauth_expires_at', 'updated_on')
+    list_select_related = ('user',)
+    list_filter = (SessionListFilter, 'refreshable')
+    # only used to show the search box: see get_search_results
+    search_fields = ['user__username', 'org']
+    show_full_result_count = False
+    actions = ['revoke_sessions']
+
+    def revoke_sessions(self, request, queryset):
+        """ Forget tokens, forcing users to authorize again """
+        revoked = queryset.update(last_token='', oauth_expires_at=None,
+                                  refreshable=False)
+        self.message_user(request, f"Revoked {revoked} Xero sessions.",
+                          messages.SUCCESS)
+
+    revoke_sessions.short_description = "Revoke selected Xero sessions"
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Case-sensitive exact match on username or org. Each column is looked
+        up on its own index and the matches combined, since case-insensitive
+        lookups and ORs across the user join would scan both tables.
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        matches = queryset.order_by()
+        pks = set(matches.filter(user__username=search_term)
+                  .values_list('pk', flat=True))
+        pks.update(matches.filter(org=search_term)
+                   .values_list('pk', flat=True))
+        return queryset.filter(pk__in=pks), False
+
+    def get_urls(self):
+        return [
+            path('session-health/',
+                 self.admin_site.admin_view(self.session_health_view),
+                 name='djxero_xerouser_session_health'),
+        ] + super().get_urls()
+
+    def session_health_view(self, request):
+        """
+        Count of active, expiring and expired sessions per org,
+        with one aggregate query per page of orgs
+        """
+        now = timezone.now()
+        counts = {name: Count('pk', filter=condition)
+                  for name, condition in _session_filters(now).items()}
+        per_org = XeroUser.objects.order_by('org').values('org') \
+            .annotate(total=Count('pk'), **counts)
+        page = Paginator(per_org, 100).get_page(request.GET.get('p'))
+        flows = XeroAuthFlowState.objects.aggregate(
+            total=Count('pk'),
+            stale=Count('pk', filter=Q(created_on__lt=now - STALE_FLOW_AGE)))
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Xero session health',
+            page=page,
+            flows=flows,
+            stale_flow_age=STALE_FLOW_AGE,
+        )
+        return TemplateResponse(request,
+                                'admin/djxero/xerouser/session_health.html',
+                                context)
 
 
 @admin.register(XeroSecret)
 class XeroSecretAdmin(admin.ModelAdmin):
     list_display = ('name', 'label')
+
+
+@admin.register(XeroOutboxItem)
+class XeroOutboxItemAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'xerouser', 'manager', 'action', 'status',
+                    'attempts', 'next_attempt_at', 'updated_on')
+    list_select_related = ('xerouser__user',)
+    list_filter = ('status', 'next_attempt_at', 'manager', 'action')
+    ordering = ('-pk',)
+    raw_id_fields = ('xerouser',)
+    show_full_result_count = False
+    actions = ['requeue', 'mark_sent']
+
+    def requeue(self, request, queryset):
+        """ Send items again on the next xero_outbox run, with a full set
+        of attempts """
+        requeued = queryset.exclude(status=XeroOutboxItem.STATUS_SENT) \
+            .update(status=XeroOutboxItem.STATUS_PENDING, attempts=0,
+                    next_attempt_at=timezone.now(),
+                    updated_on=timezone.now())
+        self.message_user(request, f"Requeued {requeued} outbox items.",
+                          messages.SUCCESS)
+
+    requeue.short_description = "Requeue selected items (unless sent)"
+
+    def mark_sent(self, request, queryset):
+        """ Record items as sent, e.g. once found in Xero after a crash """
+        marked = queryset.exclude(status=XeroOutboxItem.STATUS_SENT) \
+            .update(status=XeroOutboxItem.STATUS_SENT,
+                    updated_on=timezone.now())
+        self.message_user(request, f"Marked {marked} outbox items as sent.",
+                          messages.SUCCESS)
+
+    mark_sent.short_description = "Mark selected items as sent"
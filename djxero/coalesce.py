@@ -0,0 +1,190 @@
+#  Copyright (c) 2019 Giacomo Lacava <giac@autoepm.com>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Coalescing of identical concurrent reads ("single-flight").
+When several callers ask for the same thing at the same time, only one of
+them actually calls Xero; the others wait and get a copy of its result.
+
+Within a process this is always active. Across processes it can be enabled
+by pointing setting XERO_COALESCE_CACHE to a shared cache alias
+(e.g. memcached or redis): the first process to take the lock calls Xero,
+the others poll the cache for the result for up to XERO_COALESCE_TIMEOUT
+seconds, then give up and call Xero themselves.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# how long a shared result remains available to late followers, in seconds
+RESULT_TTL = 5
+# how often followers in other processes check for a result, in seconds
+POLL_INTERVAL = 0.1
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _count(metric):
+    with _metrics_lock:
+        _metrics[metric] = _metrics.get(metric, 0) + 1
+
+
+def get_metrics():
+    """
+    Coalescing counters for this process:
+     - calls: upstream calls actually made
+     - shared: callers served by another thread's call
+     - cache_shared: callers served by another process' call
+     - cache_fallback: callers that gave up waiting on another process
+    :return: dict
+    """
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+def make_key(*parts):
+    """
+    Build a stable key out of JSON-serializable parts,
+    e.g. make_key('xerouser', xerouser.pk, 'get', url, params).
+    Always include who is making the call: results are shared by everyone
+    using the same key, so keys must not span different credentials.
+    """
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    """ An upstream call in progress, with its eventual outcome """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ In-process coalescing of identical concurrent calls """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Run func() unless an identical call is already in progress,
+        in which case wait for it and share its outcome.
+        Every caller gets its own copy of the result, so they can't
+        trip over each other by mutating it.
+        :param key: key identifying the call (see make_key)
+        :param func: callable without arguments
+        :return: result of func()
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            _count('shared')
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return copy.deepcopy(call.result)
+
+
+_flight = SingleFlight()
+
+
+def _cache_flight(cache, key, func):
+    """
+    Cross-process coalescing over a shared Django cache.
+    Failures of the leader are not shared: followers simply retry on their
+    own once the lock is released.
+    """
+    timeout = getattr(settings, 'XERO_COALESCE_TIMEOUT', 30)
+    lock_key = f'djxero:coalesce:lock:{key}'
+    result_key = f'djxero:coalesce:result:{key}'
+
+    if cache.add(lock_key, 1, timeout):
+        try:
+            # forget results from previous flights
+            cache.delete(result_key)
+            result = func()
+            cache.set(result_key, result, RESULT_TTL)
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    missing = object()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = cache.get(result_key, missing)
+        if result is not missing:
+            _count('cache_shared')
+            return result
+        if cache.get(lock_key) is None:
+            # leader is gone without a result; one last look, then give up
+            result = cache.get(result_key, missing)
+            if result is not missing:
+                _count('cache_shared')
+                return result
+            break
+        time.sleep(POLL_INTERVAL)
+    _count('cache_fallback')
+    return func()
+
+
+def coalesce(key, func):
+    """
+    Run func(), sharing the outcome with identical concurrent calls
+    (in this process and, if XERO_COALESCE_CACHE is set, in others too).
+    Only use it for side-effect-free reads.
+    :param key: key identifying the call (see make_key)
+    :param func: callable without arguments returning a picklable result
+    :return: result of func()
+    """
+    def counted():
+        _count('calls')
+        return func()
+
+    cache_alias = getattr(settings, 'XERO_COALESCE_CACHE', None)
+    if cache_alias:
+        cache = caches[cache_alias]
+        return _flight.do(key, lambda: _cache_flight(cache, key, counted))
+    return _flight.do(key, counted)
@@ -0,0 +1,247 @@
+#  Copyright (c) 2019 Giacomo Lacava <giac@autoepm.com>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Lazy, QuerySet-like access to pyxero managers.
+pyxero returns fully-materialized lists and leaves paging to the caller;
+XeroCursor fetches one page at a time, only when needed, and prefetches the
+following page in the background while the current one is consumed.
+"""
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+# Xero returns (at most) 100 records per page on paged endpoints
+PAGE_SIZE = 100
+# Accounting API endpoints supporting the 'page' parameter; all others
+# ignore it and return everything at once
+PAGED_ENDPOINTS = {'BankTransactions', 'Contacts', 'CreditNotes', 'Invoices',
+                   'LinkedTransactions', 'ManualJournals', 'Overpayments',
+                   'Payments', 'Prepayments', 'PurchaseOrders', 'Quotes'}
+
+
+class XeroCursor:
+    """ Lazy, chainable cursor over a pyxero manager (e.g. client.contacts).
+
+    Like a Django QuerySet, nothing is fetched until the cursor is iterated
+    or indexed, and filter()/order_by()/slicing return new cursors.
+    Unlike a QuerySet, results are NOT cached: iterating twice will query
+    Xero twice, but memory is bounded to a couple of pages.
+    """
+
+    def __init__(self, manager, filters=None, order=None,
+                 start=0, stop=None, prefetch=True, paged=None,
+                 page_size=PAGE_SIZE):
+        """
+        :param manager: pyxero manager, e.g. Xero(...).invoices
+        :param filters: dict of pyxero filter() keywords
+        :param order: Xero 'order' clause, e.g. 'Name DESC'
+        :param start: index of the first record to return
+        :param stop: index after the last record to return (None: no limit)
+        :param prefetch: fetch the next page in background while iterating
+        :param paged: whether the endpoint supports paging
+                    (default: guess from the manager name)
+        :param page_size: records per page
+        """
+        self.manager = manager
+        self.filters = dict(filters or {})
+        self.order = order
+        self.start = start
+        self.stop = stop
+        self.prefetch = prefetch
+        if paged is None:
+            paged = getattr(manager, 'name', None) in PAGED_ENDPOINTS
+        self.paged = paged
+        self.page_size = page_size
+
+    def _clone(self, **kwargs):
+        clone = copy.copy(self)
+        clone.filters = dict(self.filters)
+        clone.__dict__.update(kwargs)
+        return clone
+
+    def _check_unsliced(self, action):
+        if self.start or self.stop is not None:
+            raise TypeError(f"Cannot {action} a cursor once a slice "
+                            f"has been taken.")
+
+    def filter(self, **kwargs):
+        """
+        Return a new cursor with extra pyxero filter keywords
+        (e.g. Name__contains='John', since=datetime(...)).
+        """
+        self._check_unsliced('filter')
+        for reserved in ('page', 'order', 'offset'):
+            if reserved in kwargs:
+                raise TypeError(f"'{reserved}' is managed by the cursor "
+                                f"and cannot be used as a filter.")
+        filters = dict(self.filters)
+        filters.update(kwargs)
+        return self._clone(filters=filters)
+
+    def order_by(self, *fields):
+        """
+        Return a new cursor ordered by the given fields.
+        As in Django, a leading '-' means descending order.
+        """
+        self._check_unsliced('reorder')
+        clauses = [f'{field[1:]} DESC' if field.startswith('-') else field
+                   for field in fields]
+        return self._clone(order=','.join(clauses) or None)
+
+    def _fetch_page(self, page):
+        """
+        Retrieve a single page from Xero
+        :param page: 1-based page number
+        :return: list of dicts
+        """
+        params = dict(self.filters)
+        if self.paged:
+            params['page'] = page
+        if self.order:
+            params['order'] = self.order
+        return self.manager.filter(**params)
+
+    def _prefetch_page(self, page):
+        """ _fetch_page, as run in the background thread """
+        try:
+            return self._fetch_page(page)
+        finally:
+            # fetching may have opened a connection in this thread
+            connections.close_all()
+
+    @property
+    def _filters_locally(self):
+        """ Whether some records are discarded after being fetched """
+        return False
+
+    def _matches(self, record):
+        """ Filter applied to fetched records """
+        return True
+
+    def _pages(self, first_page, last_page=None):
+        """
+        Generator of pages, from first_page up to last_page (if given).
+        While a page is being consumed, the next one is retrieved in
+        background (if prefetch is enabled), so at most two pages are held
+        in memory.
+        """
+        def has_next(page, items):
+            # unpaged endpoints return everything in one go
+            return self.paged and len(items) >= self.page_size and \
+                   (last_page is None or page < last_page)
+
+        page = first_page
+        if not self.prefetch:
+            while True:
+                items = self._fetch_page(page)
+                yield items
+                if not has_next(page, items):
+                    return
+                page += 1
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self._prefetch_page, page)
+        try:
+            while True:
+                items = future.result()
+                future = None
+                if not has_next(page, items):
+                    yield items
+                    return
+                page += 1
+                future = executor.submit(self._prefetch_page, page)
+                yield items
+        finally:
+            # consumer stopped early: don't wait on a page nobody wants
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def iterator(self):
+        """
+        Generator over the records matched by this cursor, fetching pages
+        lazily.
+        """
+        if self.stop is not None and self.stop <= self.start:
+            return
+        # positions only map to pages if every fetched record is returned
+        exact = self.paged and not self._filters_locally
+        first_page = self.start // self.page_size + 1 if exact else 1
+        last_page = None
+        if exact and self.stop is not None:
+            last_page = (self.stop - 1) // self.page_size + 1
+        position = (first_page - 1) * self.page_size
+        pages = self._pages(first_page, last_page)
+        try:
+            for items in pages:
+                for item in items:
+                    if not self._matches(item):
+                        continue
+                    if self.stop is not None and position >= self.stop:
+                        return
+                    if position >= self.start:
+                        yield item
+                    position += 1
+                if self.stop is not None and position >= self.stop:
+                    return
+        finally:
+            pages.close()
+
+    def __iter__(self):
+        return self.iterator()
+
+    def __getitem__(self, k):
+        """
+        Slicing returns a new (lazy) cursor, indexing returns a single record.
+        Negative indexes and steps are not supported.
+        """
+        if isinstance(k, slice):
+            if k.step is not None:
+                raise ValueError("Slice steps are not supported.")
+            if (k.start is not None and k.start < 0) or \
+                    (k.stop is not None and k.stop < 0):
+                raise ValueError("Negative indexing is not supported.")
+            start = self.start + (k.start or 0)
+            stop = self.stop
+            if k.stop is not None:
+                stop = self.start + k.stop
+                if self.stop is not None:
+                    stop = min(stop, self.stop)
+            return self._clone(start=start, stop=stop)
+        if not isinstance(k, int):
+            raise TypeError(f"Cursor indices must be integers or slices, "
+                            f"not {type(k).__name__}.")
+        if k < 0:
+            raise ValueError("Negative indexing is not supported.")
+        for item in self._clone(start=self.start + k,
+                                stop=self.start + k + 1,
+                                prefetch=False):
+            if self.stop is None or self.start + k < self.stop:
+                return item
+        raise IndexError("Cursor index out of range")
+
+    def first(self):
+        """
+        :return: first matching record, or None
+        """
+        try:
+            return self[0]
+        except IndexError:
+            return None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} " \
+               f"{getattr(self.manager, 'name', self.manager)} " \
+               f"filters={self.filters!r} order={self.order!r} " \
+               f"[{self.start}:{self.stop}]>"
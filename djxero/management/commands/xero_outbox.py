@@ -0,0 +1,192 @@
+#  Copyright (c) 2019 Giacomo Lacava <giac@autoepm.com>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+from xero.exceptions import XeroBadRequest
+
+from djxero.models import XeroOutboxItem, XeroUser
+from djxero.signals import xero_outbox_sent, xero_outbox_failed
+
+logger = logging.getLogger(__name__)
+
+# Xero recommends no more than 50 elements per bulk call
+BULK_SIZE = 50
+
+
+class Command(BaseCommand):
+    help = "Send pending Xero mutations recorded with " \
+           "XeroOutboxItem.enqueue(), in bulk, retrying failures with " \
+           "exponential backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Items to claim at a time "
+                                 "(default: 200)")
+        parser.add_argument('--max-attempts', type=int, default=8,
+                            help="Give up on an item after this many "
+                                 "failures (default: 8)")
+        parser.add_argument('--backoff', type=int, default=30,
+                            help="Seconds to wait after the first failure; "
+                                 "doubled on each following one "
+                                 "(default: 30)")
+        parser.add_argument('--timeout', type=int, default=60,
+                            help="Seconds to wait on each Xero call before "
+                                 "giving up and retrying later "
+                                 "(default: 60)")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, as a worker")
+        parser.add_argument('--interval', type=int, default=5,
+                            help="Seconds between runs in --loop mode "
+                                 "(default: 5)")
+
+    def handle(self, *args, **options):
+        self.max_attempts = options['max_attempts']
+        self.backoff = options['backoff']
+        self.timeout = options['timeout']
+        while True:
+            processed = self.drain(options['batch_size'])
+            if processed:
+                self.stdout.write(f"Processed {processed} outbox items.")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def drain(self, batch_size):
+        """
+        Process all items currently due, in batches. Items are claimed
+        (marked as sending) in a short transaction before calling Xero, so
+        several workers can run at the same time and nothing is sent twice
+        if a worker dies: items left as sending after a crash may or may not
+        have reached Xero, and have to be checked and then requeued or marked
+        as sent from the admin.
+        :return: number of items processed
+        """
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        processed = 0
+        while True:
+            with transaction.atomic():
+                items = list(
+                    XeroOutboxItem.objects
+                        .select_for_update(skip_locked=skip_locked)
+                        .filter(status=XeroOutboxItem.STATUS_PENDING,
+                                next_attempt_at__lte=timezone.now())
+                        .order_by('xerouser', 'manager', 'action', 'pk')
+                    [:batch_size])
+                if not items:
+                    break
+                XeroOutboxItem.objects \
+                    .filter(pk__in=[item.pk for item in items]) \
+                    .update(status=XeroOutboxItem.STATUS_SENDING,
+                            updated_on=timezone.now())
+            users = XeroUser.objects.in_bulk(
+                {item.xerouser_id for item in items})
+            # coalesce writes made with the same credentials to the same
+            # endpoint; org is not reliable enough to share credentials
+            groups = OrderedDict()
+            for item in items:
+                key = (item.xerouser_id, item.manager, item.action)
+                groups.setdefault(key, []).append(item)
+            for group in groups.values():
+                for i in range(0, len(group), BULK_SIZE):
+                    self.send(group[i:i + BULK_SIZE], users)
+            processed += len(items)
+        return processed
+
+    def send(self, items, users):
+        """
+        Send items for the same user, manager and action in one bulk call,
+        and record the outcome straight away.
+        If Xero rejects the batch, items are sent one by one to find out
+        which ones are at fault.
+        """
+        first = items[0]
+        xerouser = users[first.xerouser_id]
+        try:
+            manager = getattr(xerouser.client, first.manager)
+            data = [item.data for item in items]
+            # without a timeout, a hung connection would leave the worker
+            # stuck and the batch in sending forever
+            if first.action == 'put':
+                results = manager.put(data, summarize_errors=False,
+                                      timeout=self.timeout)
+            else:
+                results = manager.save(data, timeout=self.timeout)
+        except XeroBadRequest as e:
+            if len(items) > 1:
+                for item in items:
+                    self.send([item], users)
+            else:
+                # retrying won't fix invalid data
+                with transaction.atomic():
+                    self.fail(first, str(e))
+            return
+        except Exception as e:
+            logger.exception(e)
+            with transaction.atomic():
+                for item in items:
+                    self.retry(item, str(e))
+            return
+
+        with transaction.atomic():
+            self.record_results(items, results)
+
+    def record_results(self, items, results):
+        """ Match the objects returned by a bulk call with their items """
+        if not isinstance(results, (list, tuple)):
+            results = [results]
+        for index, item in enumerate(items):
+            result = results[index] if index < len(results) else None
+            errors = result.get('ValidationErrors') \
+                if isinstance(result, dict) else None
+            if errors:
+                self.fail(item, json.dumps(errors, cls=DjangoJSONEncoder))
+            else:
+                self.succeed(item, result)
+
+    def succeed(self, item, result):
+        item.status = XeroOutboxItem.STATUS_SENT
+        item.attempts += 1
+        item.result = json.dumps(result, cls=DjangoJSONEncoder)
+        item.error = ''
+        item.save(update_fields=['status', 'attempts', 'result', 'error',
+                                 'updated_on'])
+        transaction.on_commit(lambda: xero_outbox_sent.send(
+            sender=XeroOutboxItem, item=item, result=result))
+
+    def fail(self, item, error):
+        item.status = XeroOutboxItem.STATUS_FAILED
+        item.attempts += 1
+        item.error = error
+        item.save(update_fields=['status', 'attempts', 'error', 'updated_on'])
+        transaction.on_commit(lambda: xero_outbox_failed.send(
+            sender=XeroOutboxItem, item=item, error=error))
+
+    def retry(self, item, error):
+        if item.attempts + 1 >= self.max_attempts:
+            self.fail(item, error)
+            return
+        item.status = XeroOutboxItem.STATUS_PENDING
+        item.attempts += 1
+        item.error = error
+        item.next_attempt_at = timezone.now() + timedelta(
+            seconds=self.backoff * 2 ** (item.attempts - 1))
+        item.save(update_fields=['status', 'attempts', 'error',
+                                 'next_attempt_at', 'updated_on'])
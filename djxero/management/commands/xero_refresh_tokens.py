@@ -0,0 +1,109 @@
+#  Copyright (c) 2019 Giacomo Lacava <giac@autoepm.com>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from xero.exceptions import XeroUnauthorized
+
+from djxero.models import XeroUser, get_xero_rsa_key
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Refresh Xero tokens that are about to expire, so that users " \
+           "and long-running jobs never find them expired. " \
+           "Only Partner apps can refresh tokens."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=300,
+                            help="Refresh tokens expiring within this many "
+                                 "seconds (default: 300)")
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Tokens to refresh per transaction "
+                                 "(default: 50)")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, as a worker")
+        parser.add_argument('--interval', type=int, default=60,
+                            help="Seconds between runs in --loop mode "
+                                 "(default: 60)")
+
+    def handle(self, *args, **options):
+        if not get_xero_rsa_key():
+            self.stderr.write("No RSA key configured (secret 'xero_rsa_key'):"
+                              " tokens from Public apps cannot be refreshed.")
+            return
+        while True:
+            refreshed, failed = self.refresh_expiring(options['ahead'],
+                                                      options['batch_size'])
+            if refreshed or failed:
+                self.stdout.write(f"Refreshed {refreshed} tokens, "
+                                  f"{failed} failed.")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def refresh_expiring(self, ahead, batch_size):
+        """
+        Refresh all tokens expiring in the next `ahead` seconds, in batches.
+        Each row is locked and saved in its own transaction (skipping rows
+        locked by other workers, where the database supports it), since a
+        refresh invalidates the previous token and must never be rolled back.
+        Rows are processed at most once per run.
+        :return: tuple (refreshed count, failed count)
+        """
+        threshold = timezone.now() + timedelta(seconds=ahead)
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        refreshed = 0
+        failed = 0
+        processed = set()
+        while True:
+            batch = list(XeroUser.objects
+                         .filter(refreshable=True,
+                                 oauth_expires_at__lte=threshold)
+                         .exclude(pk__in=processed)
+                         .order_by('oauth_expires_at')
+                         .values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                break
+            processed.update(batch)
+            for pk in batch:
+                with transaction.atomic():
+                    xerouser = XeroUser.objects \
+                        .select_for_update(skip_locked=skip_locked) \
+                        .filter(pk=pk, refreshable=True,
+                                oauth_expires_at__lte=threshold).first()
+                    if xerouser is None:
+                        # refreshed or locked by another worker
+                        continue
+                    try:
+                        if xerouser.refresh():
+                            refreshed += 1
+                        else:
+                            failed += 1
+                    except XeroUnauthorized as e:
+                        # authorization expired or revoked: only the user
+                        # can fix this, so stop trying
+                        logger.warning(f"Cannot refresh token for "
+                                       f"XeroUser {xerouser.pk}: {e}")
+                        xerouser.refreshable = False
+                        xerouser.save(update_fields=['refreshable'])
+                        failed += 1
+                    except Exception as e:
+                        logger.exception(e)
+                        failed += 1
+        return refreshed, failed
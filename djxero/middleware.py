@@ -33,7 +33,9 @@ class XeroMiddleware:
             if xero_user.token['oauth_expires_at'] >= datetime.now():
                 valid_auth = True
         except (get_user_model().xerouser.RelatedObjectDoesNotExist,
-                AttributeError) as e:
+                AttributeError, ValueError, KeyError, TypeError):
+            # no Xero user, or a missing or unreadable token
+            # (e.g. revoked from the admin)
             pass
         if not valid_auth:
             return redirect(
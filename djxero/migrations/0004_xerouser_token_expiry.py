@@ -0,0 +1,67 @@
+# Generated by Django 2.2.3 on 2019-09-02 10:12
+
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+_DEFAULT_SECRETS = [('xero_rsa_key', 'RSA Private Key (Partner apps only)')]
+
+
+def load_defaults(apps, schema_editor):
+    XeroSecret = apps.get_model('djxero', 'XeroSecret')
+    db_alias = schema_editor.connection.alias
+    for name, label in _DEFAULT_SECRETS:
+        XeroSecret.objects.using(db_alias).get_or_create(
+            name=name, defaults={'label': label, 'value': ''})
+
+
+def purge_defaults(apps, schema_editor):
+    XeroSecret = apps.get_model('djxero', 'XeroSecret')
+    db_alias = schema_editor.connection.alias
+    XeroSecret.objects.using(db_alias).filter(
+        name__in=[key for key, label in _DEFAULT_SECRETS]
+    ).delete()
+
+
+def populate_expiry(apps, schema_editor):
+    XeroUser = apps.get_model('djxero', 'XeroUser')
+    db_alias = schema_editor.connection.alias
+    for xerouser in XeroUser.objects.using(db_alias).exclude(last_token=''):
+        try:
+            token = json.loads(xerouser.last_token)
+            # as serialized by DjangoJSONEncoder, e.g. 2019-07-10T11:26:05.125
+            expires_at = datetime.strptime(token['oauth_expires_at'] + '000',
+                                           "%Y-%m-%dT%H:%M:%S.%f")
+        except (TypeError, ValueError, KeyError):
+            continue
+        if settings.USE_TZ:
+            expires_at = timezone.make_aware(expires_at)
+        xerouser.oauth_expires_at = expires_at
+        xerouser.refreshable = bool(token.get('oauth_session_handle'))
+        xerouser.save(update_fields=['oauth_expires_at', 'refreshable'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djxero', '0003_xeroprojectsuser'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xerouser',
+            name='oauth_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the current token expires', null=True),
+        ),
+        migrations.AddField(
+            model_name='xerouser',
+            name='refreshable',
+            field=models.BooleanField(default=False, help_text='Whether the current token can be refreshed without user interaction (Partner apps only)'),
+        ),
+        migrations.RunPython(load_defaults, purge_defaults, elidable=True),
+        migrations.RunPython(populate_expiry, migrations.RunPython.noop,
+                             elidable=True),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.3 on 2019-09-09 14:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djxero', '0004_xerouser_token_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XeroOutboxItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('org', models.CharField(blank=True, help_text='Org this mutation belongs to; items for the same org are sent together', max_length=255, null=True)),
+                ('manager', models.CharField(help_text="pyxero manager, e.g. 'invoices'", max_length=255)),
+                ('action', models.CharField(choices=[('put', 'Create (PUT)'), ('save', 'Create or update (POST)')], default='put', max_length=10)),
+                ('payload', models.TextField(help_text='JSON of the object to send')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Do not send before this')),
+                ('result', models.TextField(blank=True, default='', help_text='JSON returned by Xero once sent')),
+                ('error', models.TextField(blank=True, default='', help_text='Last error received')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('xerouser', models.ForeignKey(help_text='User whose credentials will be used to send this', on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='djxero.XeroUser')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='xerooutboxitem',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='djxero_outbox_due_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.3 on 2019-09-16 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djxero', '0005_xerooutboxitem'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xeroauthflowstate',
+            name='created_on',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='xerouser',
+            name='org',
+            field=models.CharField(blank=True, db_index=True, help_text='Identifier for the org the user belongs to, in theory', max_length=255, null=True),
+        ),
+    ]
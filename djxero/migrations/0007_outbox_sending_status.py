@@ -0,0 +1,23 @@
+# Generated by Django 2.2.3 on 2019-09-23 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djxero', '0006_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xerooutboxitem',
+            name='org',
+            field=models.CharField(blank=True, help_text='Org this mutation belongs to', max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='xerooutboxitem',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+    ]
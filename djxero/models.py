@@ -13,15 +13,24 @@
 import json
 import logging
 from datetime import datetime
+from io import UnsupportedOperation
+from urllib.parse import quote
 
 import requests
 from django.conf import settings
+from django.core.files import File
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.models import CASCADE
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from encrypted_model_fields.fields import EncryptedTextField
 from xero import Xero
-from xero.auth import PublicCredentials
+from xero.auth import PublicCredentials, PartnerCredentials
+from xero.basemanager import BaseManager
+
+from djxero.coalesce import coalesce, make_key
+from djxero.query import XeroQuery
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +46,15 @@ def _datetime_parser_hook(adict):
     return adict
 
 
+def _payload_parser_hook(adict):
+    """ Utility for json deserialization of outbox payloads: pyxero can only
+    send dates it gets as date objects. """
+    for key, value in adict.items():
+        if key in BaseManager.DATE_FIELDS and isinstance(value, str):
+            adict[key] = parse_datetime(value) or parse_date(value) or value
+    return adict
+
+
 # todo: make secret-handling more flexible
 def get_secret(param):
     try:
@@ -54,6 +72,29 @@ def get_xero_consumer_secret():
     return get_secret('xero_consumer_secret')
 
 
+def get_xero_rsa_key():
+    return get_secret('xero_rsa_key')
+
+
+def _make_credentials(**kwargs):
+    """
+    Build the right credentials for the configured app type:
+    Partner apps (which have an RSA key) can refresh their tokens,
+    Public apps cannot.
+    """
+    rsa_key = get_xero_rsa_key()
+    if rsa_key:
+        return PartnerCredentials(rsa_key=rsa_key, **kwargs)
+    return PublicCredentials(**kwargs)
+
+
+def _db_datetime(value):
+    """ pyxero datetimes are naive local times """
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+
 # 2019-07-10T11:26:05.125
 class XeroSecret(models.Model):
     """
@@ -89,7 +130,7 @@ class XeroAuthFlowState(models.Model):
                                  blank=False,
                                  help_text="Where to redirect once successful")
 
-    created_on = models.DateTimeField(auto_now_add=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __str__(self):
         return self.created_on.isoformat() + ' ' + \
@@ -101,9 +142,9 @@ class XeroAuthFlowState(models.Model):
         Start authorization flow
         """
         # instantiating credentials automatically starts the flow
-        creds = PublicCredentials(get_xero_consumer_key(),
-                                  get_xero_consumer_secret(),
-                                  acceptance_url)
+        creds = _make_credentials(consumer_key=get_xero_consumer_key(),
+                                  consumer_secret=get_xero_consumer_secret(),
+                                  callback_uri=acceptance_url)
         # save state for later
         af_state = cls(state=json.dumps(creds.state,
                                         cls=DjangoJSONEncoder),
@@ -124,7 +165,7 @@ class XeroAuthFlowState(models.Model):
         """
         # rebuild our connection
         state_dict = json.loads(self.state, object_hook=_datetime_parser_hook)
-        creds = PublicCredentials(**state_dict)
+        creds = _make_credentials(**state_dict)
         creds.verify(verification_code)
         xero_user = XeroUser.from_state(creds, user)
         return xero_user
@@ -137,7 +178,7 @@ class XeroUser(models.Model):
                                 null=False, blank=False,
                                 help_text="Django user")
     org = models.CharField(max_length=255,
-                           blank=True, null=True,
+                           blank=True, null=True, db_index=True,
                            help_text="Identifier for the org the user belongs "
                                      "to, in theory")
     last_token = EncryptedTextField(blank=True, default='',
@@ -154,9 +195,21 @@ class XeroUser(models.Model):
                                    help_text="Email registered with Xero. "
                                              "If present, it overrides "
                                              "User.email when dealing with Xero")
+    oauth_expires_at = models.DateTimeField(blank=True, null=True,
+                                            db_index=True,
+                                            help_text="When the current token "
+                                                      "expires")
+    refreshable = models.BooleanField(default=False,
+                                      help_text="Whether the current token "
+                                                "can be refreshed without "
+                                                "user interaction "
+                                                "(Partner apps only)")
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
+    ACCOUNTING_URI = "https://api.xero.com/api.xro/2.0"
+    FILES_URI = "https://api.xero.com/files.xro/1.0"
+
     def __str__(self):
         return f"{self.user.first_name} {self.user.last_name}"
 
@@ -176,10 +229,35 @@ class XeroUser(models.Model):
         xero_user, created = cls.objects.get_or_create(
             user=user
         )
-        xero_user.last_token = json.dumps(creds.state, cls=DjangoJSONEncoder)
+        xero_user._set_credentials(creds)
         xero_user.save()
         return xero_user
 
+    def _set_credentials(self, creds: PublicCredentials):
+        """ Store the state of the given credentials """
+        self.last_token = json.dumps(creds.state, cls=DjangoJSONEncoder)
+        self.oauth_expires_at = _db_datetime(creds.oauth_expires_at)
+        self.refreshable = isinstance(creds, PartnerCredentials) and \
+            bool(creds.oauth_session_handle)
+
+    def refresh(self):
+        """
+        Renew the current token ahead of its expiry, without user interaction.
+        Only possible with Partner apps; Public app users have to go
+        through the authorization flow again.
+        :return: True if refreshed, False if the token cannot be refreshed
+        """
+        if not self.refreshable or not self.last_token:
+            return False
+        creds = _make_credentials(**self.token)
+        if not isinstance(creds, PartnerCredentials):
+            return False
+        creds.refresh()
+        self._set_credentials(creds)
+        self.save(update_fields=['last_token', 'oauth_expires_at',
+                                 'refreshable', 'updated_on'])
+        return True
+
     @property
     def token(self):
         """
@@ -194,9 +272,27 @@ class XeroUser(models.Model):
         Get a ready-made xero.Xero object
         :return: xero.Xero instance
         """
-        return Xero(credentials=PublicCredentials(**self.token),
+        return Xero(credentials=_make_credentials(**self.token),
                     user_agent=get_xero_consumer_key())
 
+    def query(self, endpoint, **kwargs):
+        """
+        Get a lazy, QuerySet-like query over an API endpoint. Filters are
+        sent to Xero whenever possible, and pages are only fetched when the
+        query is consumed, e.g.
+        xerouser.query('contacts').filter(IsCustomer=True)[:10]
+        will only retrieve the first page of matching contacts.
+        :param endpoint: endpoint name, e.g. 'Invoices' (pyxero manager
+                    names, e.g. 'invoices', work too)
+        :param kwargs: extra XeroQuery parameters (e.g. base_uri)
+        :return: XeroQuery instance
+        """
+        for name in Xero.OBJECT_LIST:
+            if name.lower() == endpoint.lower():
+                endpoint = name
+                break
+        return XeroQuery(self, endpoint, **kwargs)
+
     def guess_user_details(self):
         """
         Xero provides no way to find user details from a oauth1.0 token, but
@@ -244,6 +340,19 @@ class XeroUser(models.Model):
         :param kwargs: extra parameters to pass to requests
         :return: list of returned json dicts
         """
+        if verb.lower() == 'get' and self.pk is not None and \
+                getattr(settings, 'XERO_COALESCE_GETS', True):
+            # identical concurrent reads with the same credentials share one
+            # call; never share across users, what they see may differ
+            key = make_key('xerouser', self.pk, verb.lower(), url, kwargs)
+            return coalesce(key,
+                            lambda: self._fetch_data(verb, url, **kwargs))
+        return self._fetch_data(verb, url, **kwargs)
+
+    def _fetch_data(self, verb, url, **kwargs):
+        """
+        Uncoalesced version of _request_data
+        """
         result = self._request(verb, url, **kwargs)
         if result.status_code != 200:
             raise Exception(f"Unexpected response: "
@@ -265,17 +374,121 @@ class XeroUser(models.Model):
         :return: list of returned json dicts
         """
         creds = self.client.accounts.credentials
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['User-Agent'] = creds.consumer_key
         try:
             result = getattr(
                 requests, verb.lower()
             )(url, auth=creds.oauth,
-              headers={'User-Agent': creds.consumer_key},
+              headers=headers,
               **kwargs)
             return result
         except Exception as e:
             logger.exception(e)
             return None
 
+    def upload_attachment(self, endpoint, guid, filename, content,
+                          content_type='application/octet-stream',
+                          include_online=False):
+        """
+        Upload an attachment to a Xero object, streaming it from a file-like
+        object or a Django File (so it's never read fully in memory).
+        :param endpoint: Accounting API endpoint, e.g. 'Invoices'
+        :param guid: ID of the object to attach to
+        :param filename: name of the attachment in Xero
+        :param content: binary file-like object or django File
+        :param content_type: MIME type of the attachment
+        :param include_online: whether the attachment should be visible
+                            in online invoices
+        :return: dict describing the new attachment
+        """
+        if isinstance(content, File):
+            # Django Files iterate by line, which would buffer binaries,
+            # so hand the underlying file to requests instead
+            content.open('rb')
+            content = content.file
+        try:
+            content.seek(0)
+        except (AttributeError, UnsupportedOperation):
+            pass
+        url = '/'.join([self.ACCOUNTING_URI, endpoint, guid,
+                        'Attachments', quote(filename)])
+        params = {'IncludeOnline': 'true'} if include_online else {}
+        # requests streams file-like bodies, reading them block by block
+        result = self._request('put', url, data=content, params=params,
+                               headers={'Content-Type': content_type,
+                                        'Accept': 'application/json'})
+        self._check_response(result, 'put', url)
+        return result.json()['Attachments'][0]
+
+    def download_attachment(self, endpoint, guid, filename, destination,
+                            storage=None,
+                            content_type='application/octet-stream'):
+        """
+        Download an attachment from a Xero object, streaming it in chunks.
+        :param endpoint: Accounting API endpoint, e.g. 'Invoices'
+        :param guid: ID of the object the file is attached to
+        :param filename: name of the attachment in Xero
+        :param destination: writable binary file-like object or, if storage
+                        is specified, name of the file to save
+        :param storage: Django Storage instance to save the file to
+        :param content_type: MIME type to request
+        :return: number of bytes written or, if storage is specified,
+                name of the saved file
+        """
+        url = '/'.join([self.ACCOUNTING_URI, endpoint, guid,
+                        'Attachments', quote(filename)])
+        return self._download(url, destination, storage, content_type)
+
+    def download_file(self, file_id, destination, storage=None,
+                      content_type='application/octet-stream'):
+        """
+        Download content from the Files API, streaming it in chunks.
+        :param file_id: ID of the file in Xero
+        :param destination: writable binary file-like object or, if storage
+                        is specified, name of the file to save
+        :param storage: Django Storage instance to save the file to
+        :param content_type: MIME type to request
+        :return: number of bytes written or, if storage is specified,
+                name of the saved file
+        """
+        url = '/'.join([self.FILES_URI, 'Files', file_id, 'Content'])
+        return self._download(url, destination, storage, content_type)
+
+    def _download(self, url, destination, storage, content_type):
+        """
+        Stream a binary response to a file-like object or Storage.
+        """
+        result = self._request('get', url, stream=True,
+                               headers={'Accept': content_type})
+        if result is None:
+            self._check_response(result, 'get', url)
+        # release the connection even when the response is an error
+        with result:
+            self._check_response(result, 'get', url)
+            if storage is not None:
+                # transparently decompress gzip'd transfers
+                result.raw.decode_content = True
+                content = File(result.raw, name=destination)
+                if 'Content-Length' in result.headers \
+                        and 'Content-Encoding' not in result.headers:
+                    content.size = int(result.headers['Content-Length'])
+                return storage.save(destination, content)
+            written = 0
+            for chunk in result.iter_content(File.DEFAULT_CHUNK_SIZE):
+                destination.write(chunk)
+                written += len(chunk)
+            return written
+
+    @staticmethod
+    def _check_response(result, verb, url):
+        if result is None:
+            raise Exception(f"Call failed: {verb} {url}")
+        if result.status_code != 200:
+            raise Exception(f"Unexpected response: "
+                            f"{result.status_code} {result.text}\n"
+                            f"Call was: {verb} {url}")
+
 
 class XeroProjectsUser(models.Model):
     """ It turns out that the Projects API has different IDs..."""
@@ -295,22 +508,96 @@ class XeroProjectsUser(models.Model):
 
         :return: dict with user details that we *think* might be from the user
                 who generated the token, or None if not found anything"""
-        page = 1
-        pagesize = 50
-        end_page = 2
         email_lookup = self.xerouser.xero_email or self.xerouser.user.email
         if not email_lookup:
             raise Exception("You cannot guess a Projects user without an email "
                             "set. Add a value to XeroUser.xero_email or "
                             "User.email, and try again.")
-        while page <= end_page:
-            url = f'{self.BASE_URI}/projectsusers?page={page}&pagesize={pagesize}'
-            result = self.xerouser._request_data('get', url)
-            for user in result['items']:
-                if user['email'] == email_lookup:
-                    return user['userId']
-            # not found? next page
-            end_page = result['pageCount']
-            page += 1
-        # still here ? Not found
-        return None
+        # the Projects API can't filter users, so use the largest pages it
+        # allows and stop at the first match
+        query = self.xerouser.query('projectsusers', base_uri=self.BASE_URI,
+                                    results_key='items', paged=True,
+                                    page_size=500, page_size_param='pagesize',
+                                    server_side=False)
+        user = query.filter(email=email_lookup).first()
+        return user['userId'] if user else None
+
+
+class XeroOutboxItem(models.Model):
+    """ A Xero mutation waiting to be sent, so views don't have to wait on
+    Xero. Items are created in the same transaction as your own writes,
+    and sent in bulk by the xero_outbox command. """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [(STATUS_PENDING, 'Pending'),
+                      (STATUS_SENDING, 'Sending'),
+                      (STATUS_SENT, 'Sent'),
+                      (STATUS_FAILED, 'Failed')]
+    ACTION_CHOICES = [('put', 'Create (PUT)'),
+                      ('save', 'Create or update (POST)')]
+
+    xerouser = models.ForeignKey(XeroUser, on_delete=CASCADE,
+                                 related_name='outbox',
+                                 help_text="User whose credentials will be "
+                                           "used to send this")
+    org = models.CharField(max_length=255, blank=True, null=True,
+                           help_text="Org this mutation belongs to")
+    manager = models.CharField(max_length=255,
+                               help_text="pyxero manager, e.g. 'invoices'")
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES,
+                              default='put')
+    payload = models.TextField(help_text="JSON of the object to send")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           help_text="Do not send before this")
+    result = models.TextField(blank=True, default='',
+                              help_text="JSON returned by Xero once sent")
+    error = models.TextField(blank=True, default='',
+                             help_text="Last error received")
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'],
+                         name='djxero_outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.manager} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, xerouser, manager, data, action='put'):
+        """
+        Record a mutation to be sent to Xero later.
+        Call it inside your own transaction.atomic() block, so the
+        mutation is recorded if and only if your changes are committed.
+        :param xerouser: XeroUser whose credentials will be used
+        :param manager: pyxero manager name, e.g. 'invoices'
+        :param data: dict to send, as you would pass to pyxero put()/save()
+        :param action: 'put' (create) or 'save' (create or update)
+        :return: XeroOutboxItem instance
+        """
+        # catch typos now, rather than after hours of retries in the worker
+        managers = {name.lower() for name in Xero.OBJECT_LIST}
+        if manager.lower() not in managers:
+            raise ValueError(f"Unknown pyxero manager '{manager}'")
+        if action not in dict(cls.ACTION_CHOICES):
+            raise ValueError(f"Unknown outbox action '{action}'")
+        manager = manager.lower()
+        return cls.objects.create(xerouser=xerouser, org=xerouser.org,
+                                  manager=manager, action=action,
+                                  payload=json.dumps(data,
+                                                     cls=DjangoJSONEncoder))
+
+    @property
+    def data(self):
+        """
+        Get the object to send, with dates parsed back for pyxero
+        :return: dict
+        """
+        return json.loads(self.payload, object_hook=_payload_parser_hook)
@@ -0,0 +1,342 @@
+#  Copyright (c) 2019 Giacomo Lacava <giac@autoepm.com>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Query builder pushing filters down to Xero.
+Lookups are compiled into the server-side `where`, `order`, `IDs`,
+`Statuses`, `summaryOnly` and If-Modified-Since parameters, so only matching
+records come back over the wire. Whatever the API can't express is
+checked in Python instead.
+"""
+
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from uuid import UUID
+
+from xero.utils import parse_date
+
+from djxero.cursor import PAGED_ENDPOINTS, PAGE_SIZE, XeroCursor
+
+
+# lookup -> Xero operator
+OPERATORS = {'eq': '==', 'ne': '!=',
+             'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+# lookup -> Xero string function
+FUNCTIONS = {'contains': 'Contains',
+             'startswith': 'StartsWith',
+             'endswith': 'EndsWith'}
+# lookups Xero can't do, always checked in Python
+LOCAL_LOOKUPS = {'iexact', 'icontains', 'istartswith', 'iendswith'}
+LOOKUPS = set(OPERATORS) | set(FUNCTIONS) | LOCAL_LOOKUPS | {'in', 'isnull'}
+
+
+def _literal(field, value):
+    """
+    Format a value the way Xero expects it in a `where` clause
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return f'DateTime({value.year},{value.month},{value.day},' \
+               f'{value.hour},{value.minute},{value.second})'
+    if isinstance(value, date):
+        return f'DateTime({value.year},{value.month},{value.day})'
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    # only guess from the name once the value itself is known not to be
+    # anything else; case-sensitive like pyxero, so AmountPaid isn't an ID
+    if isinstance(value, UUID) or field.endswith('ID'):
+        return f'Guid("{value}")'
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def _lookup_value(record, path, parse_dates=False):
+    """
+    Retrieve a (possibly nested) value from a record,
+    converting Xero-formatted dates if requested
+    """
+    value = record
+    for part in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    if parse_dates and isinstance(value, str):
+        value = parse_date(value) or value
+    return value
+
+
+def _coerce(value, other):
+    """ Make a record value comparable with a lookup value """
+    if isinstance(other, UUID) and isinstance(value, str):
+        return UUID(value)
+    if isinstance(other, datetime) and isinstance(value, date) and \
+            not isinstance(value, datetime):
+        # Xero sends midnight as a plain date
+        value = datetime.combine(value, time())
+    if isinstance(value, datetime) and isinstance(other, datetime):
+        # Xero dates are UTC, and so are naive lookup values assumed to be:
+        # make both sides aware, or both naive
+        if value.tzinfo is None and other.tzinfo is not None:
+            return value.replace(tzinfo=timezone.utc)
+        if value.tzinfo is not None and other.tzinfo is None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, datetime) and isinstance(other, date):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.date()
+    return value
+
+
+class _Predicate:
+    """ A single field lookup, e.g. Contact__Name__startswith='A' """
+
+    def __init__(self, key, value):
+        parts = key.split('__')
+        self.lookup = 'eq'
+        if len(parts) > 1 and parts[-1] in LOOKUPS:
+            self.lookup = parts.pop()
+        self.path = parts
+        self.field = '.'.join(parts)
+        self.value = list(value) if self.lookup == 'in' else value
+
+    @property
+    def server_side(self):
+        return self.lookup not in LOCAL_LOOKUPS
+
+    def compile(self):
+        """
+        :return: expression for Xero's `where` parameter
+        """
+        if self.lookup in OPERATORS:
+            return f'{self.field}{OPERATORS[self.lookup]}' \
+                   f'{_literal(self.field, self.value)}'
+        if self.lookup in FUNCTIONS:
+            return f'{self.field}.{FUNCTIONS[self.lookup]}' \
+                   f'({_literal(self.field, self.value)})'
+        if self.lookup == 'isnull':
+            return f'{self.field}{"==" if self.value else "!="}null'
+        if self.lookup == 'in':
+            if not self.value:
+                raise ValueError(f"Lookup '{self.field}__in' with an empty "
+                                 f"list matches nothing")
+            return '(' + ' OR '.join(f'{self.field}=={_literal(self.field, v)}'
+                                     for v in self.value) + ')'
+        raise ValueError(f"Lookup '{self.lookup}' cannot be sent to Xero")
+
+    def matches(self, record):
+        """
+        Evaluate this lookup in Python
+        :param record: dict as returned by Xero
+        :return: bool
+        """
+        values = self.value if self.lookup == 'in' else [self.value]
+        # only look for dates where dates are expected, so that strings
+        # that happen to look like dates can still be compared as strings
+        parse_dates = self.lookup not in FUNCTIONS and \
+            self.lookup not in LOCAL_LOOKUPS and \
+            any(isinstance(v, date) for v in values)
+        value = _lookup_value(record, self.path, parse_dates)
+        if self.lookup == 'isnull':
+            return (value is None) == bool(self.value)
+        if self.lookup == 'in':
+            return any(_coerce(value, v) == v for v in self.value)
+        if self.lookup in LOCAL_LOOKUPS or self.lookup in FUNCTIONS:
+            if value is None:
+                return False
+            value, other = str(value), str(self.value)
+            lookup = self.lookup
+            if lookup in LOCAL_LOOKUPS:
+                value, other = value.casefold(), other.casefold()
+                lookup = 'eq' if lookup == 'iexact' else lookup[1:]
+            if lookup == 'eq':
+                return value == other
+            if lookup == 'contains':
+                return other in value
+            return getattr(value, lookup)(other)
+        value = _coerce(value, self.value)
+        if self.lookup == 'eq':
+            return value == self.value
+        if self.lookup == 'ne':
+            return value != self.value
+        if value is None or self.value is None:
+            return False
+        try:
+            if self.lookup == 'gt':
+                return value > self.value
+            if self.lookup == 'gte':
+                return value >= self.value
+            if self.lookup == 'lt':
+                return value < self.value
+            return value <= self.value
+        except TypeError:
+            return False
+
+
+class XeroQuery(XeroCursor):
+    """ Lazy, chainable query against a Xero API endpoint.
+
+    Filters are sent to Xero whenever the API can express them, e.g.
+    XeroQuery(xerouser, 'Invoices').filter(Contact__Name__startswith='A',
+                                            AmountDue__gt=0)[:10]
+    only retrieves matching invoices. Paging, slicing and prefetching work
+    as in XeroCursor, and results are not cached either.
+    """
+
+    def __init__(self, xerouser, endpoint, base_uri=None, results_key=None,
+                 paged=None, page_size=PAGE_SIZE, page_size_param=None,
+                 server_side=True, prefetch=True):
+        """
+        :param xerouser: XeroUser whose credentials will be used
+        :param endpoint: endpoint name, e.g. 'Invoices'
+        :param base_uri: API root (default: Accounting API)
+        :param results_key: key holding the records in responses
+                        (default: the endpoint name)
+        :param paged: whether the endpoint is paged (default: guess)
+        :param page_size: records per page
+        :param page_size_param: name of the page size parameter, if the
+                        endpoint accepts one
+        :param server_side: False if the endpoint doesn't support `where`,
+                        so all filters have to run in Python
+        :param prefetch: fetch the next page in background while iterating
+        """
+        if paged is None:
+            paged = endpoint in PAGED_ENDPOINTS
+        super().__init__(None, prefetch=prefetch, paged=paged,
+                         page_size=page_size)
+        self.xerouser = xerouser
+        self.endpoint = endpoint
+        self.base_uri = base_uri or xerouser.ACCOUNTING_URI
+        self.results_key = results_key or endpoint
+        self.page_size_param = page_size_param
+        self.server_side = server_side
+        self._predicates = []
+        self._local = []
+        self._ids = []
+        self._statuses = []
+        self._summary_only = False
+        self._since = None
+
+    def _clone(self, **kwargs):
+        clone = super()._clone(**kwargs)
+        for attr in ('_predicates', '_local', '_ids', '_statuses'):
+            setattr(clone, attr, list(getattr(self, attr)))
+        return clone
+
+    def filter(self, *predicates, **lookups):
+        """
+        Add filters. Lookups follow Django conventions
+        (Name__startswith='A', Total__gte=100, Contact__ContactID=uuid,
+        Status__in=[...], Reference__isnull=True, ...); callables taking a
+        record and returning a bool are always evaluated in Python.
+        """
+        self._check_unsliced('filter')
+        clone = self._clone()
+        for key, value in lookups.items():
+            clone._predicates.append(_Predicate(key, value))
+        clone._local.extend(predicates)
+        return clone
+
+    def ids(self, *ids):
+        """ Only retrieve records with these IDs """
+        self._check_unsliced('filter')
+        clone = self._clone()
+        clone._ids.extend(str(i) for i in ids)
+        return clone
+
+    def statuses(self, *statuses):
+        """ Only retrieve records with these statuses """
+        self._check_unsliced('filter')
+        clone = self._clone()
+        clone._statuses.extend(statuses)
+        return clone
+
+    def summary_only(self):
+        """ Skip line items and other heavy details """
+        return self._clone(_summary_only=True)
+
+    def modified_since(self, when):
+        """ Only retrieve records modified after this datetime """
+        self._check_unsliced('filter')
+        return self._clone(_since=when)
+
+    def compile(self):
+        """
+        :return: tuple (query parameters dict, headers dict) for Xero
+        """
+        params = {}
+        headers = {'Accept': 'application/json'}
+        if self.server_side:
+            clauses = [p.compile() for p in self._predicates if p.server_side]
+            if clauses:
+                params['where'] = ' AND '.join(clauses)
+        if self.order:
+            params['order'] = self.order
+        if self._ids:
+            params['IDs'] = ','.join(self._ids)
+        if self._statuses:
+            params['Statuses'] = ','.join(self._statuses)
+        if self._summary_only:
+            params['summaryOnly'] = 'true'
+        if self._since is not None:
+            since = self._since
+            if since.tzinfo is not None:
+                since = since.astimezone(timezone.utc)
+            headers['If-Modified-Since'] = \
+                since.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        if self.paged and self.page_size_param:
+            params[self.page_size_param] = self.page_size
+        return params, headers
+
+    def _fetch_page(self, page):
+        params, headers = self.compile()
+        if self.paged:
+            params['page'] = page
+        data = self.xerouser._request_data(
+            'get', f'{self.base_uri}/{self.endpoint}',
+            params=params, headers=headers)
+        return data.get(self.results_key) or []
+
+    @property
+    def _matches_nothing(self):
+        """ Whether an empty __in lookup rules out every record """
+        return any(predicate.lookup == 'in' and not predicate.value
+                   for predicate in self._predicates)
+
+    def iterator(self):
+        """
+        As XeroCursor.iterator, without calling Xero at all if no record
+        can match (as with an empty __in list).
+        """
+        if self._matches_nothing:
+            return iter(())
+        return super().iterator()
+
+    @property
+    def _filters_locally(self):
+        return bool(self._local) or any(
+            not self.server_side or not predicate.server_side
+            for predicate in self._predicates)
+
+    def _matches(self, record):
+        for predicate in self._predicates:
+            if (not self.server_side or not predicate.server_side) and \
+                    not predicate.matches(record):
+                return False
+        return all(func(record) for func in self._local)
+
+    def __repr__(self):
+        params = 'EMPTY' if self._matches_nothing else repr(self.compile()[0])
+        return f"<{self.__class__.__name__} {self.endpoint} " \
+               f"{params} [{self.start}:{self.stop}]>"
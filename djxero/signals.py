@@ -11,11 +11,17 @@
 #  limitations under the License.
 
 from django.contrib.auth.signals import user_logged_out
-from django.dispatch import receiver
+from django.dispatch import receiver, Signal
+
+# sent by the xero_outbox command for each XeroOutboxItem it processes
+xero_outbox_sent = Signal(providing_args=['item', 'result'])
+xero_outbox_failed = Signal(providing_args=['item', 'error'])
 
 
 @receiver(user_logged_out)
 def djxero_logout(sender, request, user, **kwargs):
     if user.xerouser:
         user.xerouser.last_token = None
+        user.xerouser.oauth_expires_at = None
+        user.xerouser.refreshable = False
         user.xerouser.save()
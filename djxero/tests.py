@@ -1,3 +1,130 @@
-from django.test import TestCase
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from unittest import mock
+from uuid import UUID
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from djxero.query import XeroQuery, _Predicate
+
+CONTACT_ID = UUID('4ec0e5b6-7e36-4a74-8f0a-4ea8e0c1d3e5')
+
+
+def where(**lookups):
+    """ Compile lookups into Xero's `where` parameter """
+    query = XeroQuery(mock.Mock(), 'Invoices').filter(**lookups)
+    return query.compile()[0].get('where')
+
+
+class CompileTest(SimpleTestCase):
+
+    def test_ids(self):
+        self.assertEqual(where(Contact__ContactID=CONTACT_ID),
+                         f'Contact.ContactID==Guid("{CONTACT_ID}")')
+        self.assertEqual(where(InvoiceID=str(CONTACT_ID)),
+                         f'InvoiceID==Guid("{CONTACT_ID}")')
+
+    def test_numbers(self):
+        # names ending in "id" are not IDs
+        self.assertEqual(where(AmountPaid__gt=0), 'AmountPaid>0')
+        self.assertEqual(where(AmountPaid__lte=100.5), 'AmountPaid<=100.5')
+        self.assertEqual(where(Total__gte=Decimal('9.99')), 'Total>=9.99')
+
+    def test_dates(self):
+        self.assertEqual(where(Date__gte=date(2018, 1, 2)),
+                         'Date>=DateTime(2018,1,2)')
+        self.assertEqual(where(UpdatedDateUTC__lt=datetime(2018, 1, 2, 3, 4,
+                                                           5)),
+                         'UpdatedDateUTC<DateTime(2018,1,2,3,4,5)')
+
+    def test_strings(self):
+        self.assertEqual(where(Status='PAID'), 'Status=="PAID"')
+        self.assertEqual(where(Contact__Name__startswith='A'),
+                         'Contact.Name.StartsWith("A")')
+        self.assertEqual(where(Reference__contains='say "hi" \\o/'),
+                         'Reference.Contains("say \\"hi\\" \\\\o/")')
+
+    def test_bools_and_nulls(self):
+        self.assertEqual(where(IsDiscounted=False), 'IsDiscounted==false')
+        self.assertEqual(where(Reference__isnull=True), 'Reference==null')
+        self.assertEqual(where(Reference__isnull=False), 'Reference!=null')
+
+    def test_in(self):
+        self.assertEqual(where(Status__in=['PAID', 'VOIDED']),
+                         '(Status=="PAID" OR Status=="VOIDED")')
+
+    def test_empty_in(self):
+        xerouser = mock.Mock()
+        query = XeroQuery(xerouser, 'Invoices').filter(Status__in=[])
+        self.assertEqual(list(query), [])
+        self.assertIsNone(query.first())
+        xerouser._request_data.assert_not_called()
+        with self.assertRaises(ValueError):
+            query.compile()
+
+    def test_local_lookups(self):
+        query = XeroQuery(mock.Mock(), 'Invoices') \
+            .filter(Status='PAID', Reference__icontains='x')
+        self.assertEqual(query.compile()[0]['where'], 'Status=="PAID"')
+        query = XeroQuery(mock.Mock(), 'Invoices', server_side=False) \
+            .filter(Status='PAID')
+        self.assertNotIn('where', query.compile()[0])
+
+
+class MatchesTest(SimpleTestCase):
+    # 2018-02-15 09:12:30 UTC, in the formats Xero uses
+    RECORDS = [{'Date': '/Date(1518685950000+0000)/'},
+               {'Date': '2018-02-15T09:12:30'}]
+
+    def matches(self, record, **lookups):
+        (key, value), = lookups.items()
+        return _Predicate(key, value).matches(record)
+
+    def test_naive_dates(self):
+        for record in self.RECORDS:
+            self.assertTrue(self.matches(record,
+                                         Date__gte=datetime(2018, 1, 1)))
+            self.assertFalse(self.matches(record,
+                                          Date__lt=datetime(2018, 1, 1)))
+            self.assertTrue(self.matches(record,
+                                         Date=datetime(2018, 2, 15, 9, 12,
+                                                       30)))
+            self.assertFalse(self.matches(record,
+                                          Date__ne=datetime(2018, 2, 15, 9,
+                                                            12, 30)))
+            self.assertTrue(self.matches(record, Date__in=[
+                datetime(2018, 2, 15, 9, 12, 30)]))
+
+    def test_aware_dates(self):
+        for record in self.RECORDS:
+            self.assertTrue(self.matches(record, Date__gte=datetime(
+                2018, 1, 1, tzinfo=timezone.utc)))
+            self.assertTrue(self.matches(record, Date=datetime(
+                2018, 2, 15, 9, 12, 30, tzinfo=timezone.utc)))
+
+    def test_plain_dates(self):
+        for record in self.RECORDS + [{'Date': '2018-02-15T00:00:00'}]:
+            self.assertTrue(self.matches(record, Date=date(2018, 2, 15)))
+            self.assertTrue(self.matches(record, Date__gt=date(2018, 2, 14)))
+        self.assertTrue(self.matches({'Date': '2018-02-15T00:00:00'},
+                                     Date__lt=datetime(2018, 2, 15, 1)))
+
+    def test_strings(self):
+        record = {'Reference': '2018-02-15T09:12:30', 'Name': 'Acme Ltd'}
+        self.assertTrue(self.matches(record,
+                                     Reference__startswith='2018-02'))
+        self.assertTrue(self.matches(record, Name__icontains='ACME'))
+        self.assertFalse(self.matches(record, Name__endswith='Inc'))
+        self.assertTrue(self.matches({}, Name__isnull=True))
+
+    def test_local_query(self):
+        xerouser = mock.Mock()
+        xerouser._request_data.return_value = {'Invoices': [
+            {'InvoiceID': str(i), 'Date': f'/Date({ms}+0000)/'}
+            for i, ms in enumerate([1483228800000, 1518685950000])]}
+        query = XeroQuery(xerouser, 'Invoices', server_side=False,
+                          prefetch=False)
+        self.assertEqual(
+            [r['InvoiceID']
+             for r in query.filter(Date__gte=datetime(2018, 1, 1))],
+            ['1'])